@@ -1,15 +1,21 @@
 import os
-import hashlib
-import hmac
-import base64
+import asyncio
 import logging
+import httpx
+import orjson
 from fastapi import FastAPI, Request, Header
-from fastapi.responses import PlainTextResponse
+from fastapi.responses import ORJSONResponse, PlainTextResponse
 from dotenv import load_dotenv
-from openai import OpenAI, APITimeoutError, APIError
-from linebot import LineBotApi, WebhookParser
-from linebot.exceptions import InvalidSignatureError, LineBotApiError
-from linebot.models import TextSendMessage, MessageEvent, TextMessage
+from openai import AsyncOpenAI, APITimeoutError, APIError
+from linebot.v3.webhook import WebhookParser, WebhookPayload
+from linebot.v3.exceptions import InvalidSignatureError
+from linebot.v3.webhooks import MessageEvent, TextMessageContent
+
+from cache import CACHEABLE_TEMPERATURE, build_caches, embed, exact_key
+from helpers import (
+    STREAM_MIN_TOKENS, conversation_id, decide_response_params, split_flushable,
+    verify_signature,
+)
 
 # ---------- 日誌與環境變數 ----------
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -20,17 +26,45 @@ load_dotenv()
 LINE_CHANNEL_SECRET = os.getenv("LINE_CHANNEL_SECRET")
 LINE_CHANNEL_ACCESS_TOKEN = os.getenv("LINE_CHANNEL_ACCESS_TOKEN")
 DEEPSEEK_API_KEY = os.getenv("DEEPSEEK_API_KEY")
+REDIS_URL = os.getenv("REDIS_URL")
 
 # ---------- 初始化 ----------
-client = OpenAI(
+# 有 REDIS_URL 時快取放 Redis，所有 worker 共用；沒有就退回行程內記憶體
+exact_cache, semantic_cache, redis_client = build_caches(REDIS_URL)
+
+# 共用連線池：DeepSeek 的 TLS 連線建立一次後重複使用
+shared_http = httpx.AsyncClient(
+    timeout=25.0,
+    http2=True,
+    limits=httpx.Limits(max_keepalive_connections=50, max_connections=100),
+)
+
+client = AsyncOpenAI(
     api_key=DEEPSEEK_API_KEY,
     base_url="https://api.deepseek.com/v1",
     timeout=25.0, # 稍微拉長等待時間，避免 Reply Token 過期
-    max_retries=1
+    max_retries=1,
+    http_client=shared_http,
 )
 
-line_bot_api = LineBotApi(LINE_CHANNEL_ACCESS_TOKEN) if LINE_CHANNEL_ACCESS_TOKEN else None
-parser = WebhookParser(LINE_CHANNEL_SECRET) if LINE_CHANNEL_SECRET else None
+# LINE 的 messaging 模組很大，第一次要送訊息時才載入，見 get_line_api()。
+# 注意 linebot/__init__.py 仍會載入 v2 的 requests 相依，這部分省不掉。
+_line_api_client = None
+_line_bot_api = None
+_line_messaging = None
+
+def get_line_api():
+    # aiohttp session 要在 event loop 裡建立，所以也一併延後到第一次使用
+    global _line_api_client, _line_bot_api, _line_messaging
+    if _line_bot_api is None:
+        from linebot.v3 import messaging
+        _line_messaging = messaging
+        _line_api_client = messaging.AsyncApiClient(
+            messaging.Configuration(access_token=LINE_CHANNEL_ACCESS_TOKEN)
+        )
+        _line_bot_api = messaging.AsyncMessagingApi(_line_api_client)
+    return _line_bot_api
+
 # ---------- 植生牆大師系統提示詞（加入話題聚焦）----------
 
 BASE_SYSTEM_PROMPT = """
@@ -56,64 +90,240 @@ BASE_SYSTEM_PROMPT = """
 - 如果使用者問「哪種系統好」或「毛氈式怎樣」，才可以深入說明。
 - 簡單來說：要知道什麼時候該講技術，什麼時候該閉嘴！
 """
-# ---------- 輔助函數 ----------
-def verify_signature(body: bytes, signature: str) -> bool:
-    if not LINE_CHANNEL_SECRET: return False
-    hash = hmac.new(LINE_CHANNEL_SECRET.encode('utf-8'), body, hashlib.sha256).digest()
-    return base64.b64encode(hash).decode() == signature
+# 修改提示詞時記得跟著改版號，讓舊的快取回覆失效
+PROMPT_VERSION = "v3"
+# 少於這個字數的訊息不做語意快取比對
+MIN_SEMANTIC_CHARS = 4
+# 正常的植栽問題遠低於這個長度
+MAX_USER_MSG_CHARS = 2000
+# ---------- LINE ----------
+class OrjsonWebhookParser(WebhookParser):
+    """直接吃 bytes 的 WebhookParser：用 orjson 解析，省掉 decode 成 str 那一步。
+
+    我們只處理訊息事件，其他事件類型直接略過；解析失敗的單一事件
+    也只略過它自己，不影響同一批的其他訊息。
+    """
+
+    def __init__(self, channel_secret: str, *args, **kwargs):
+        super().__init__(channel_secret, *args, **kwargs)
+        # 只在建構時 encode 一次，每次驗章直接用
+        self._secret_bytes = channel_secret.encode('utf-8')
+
+    def parse(self, body: bytes, signature: str, as_payload: bool = False):
+        if (not self.skip_signature_verification()
+                and not verify_signature(body, signature, self._secret_bytes)):
+            raise InvalidSignatureError(f"Invalid signature. signature={signature}")
+        payload = orjson.loads(body)
+        events = []
+        for event in payload.get("events", []):
+            if not isinstance(event, dict) or event.get("type") != "message":
+                continue
+            try:
+                events.append(MessageEvent.from_dict(event))
+            except ValueError as e:
+                logger.warning("略過無法解析的事件: %s", e)
+        if as_payload:
+            return WebhookPayload(events=events, destination=payload.get("destination"))
+        return events
+
+parser = OrjsonWebhookParser(LINE_CHANNEL_SECRET) if LINE_CHANNEL_SECRET else None
+
+class LineReplier:
+    """第一則訊息用 reply_message (免費)，之後或 Token 過期就改用 push。"""
+
+    def __init__(self, to: str, reply_token: str):
+        self.to = to
+        self.reply_token = reply_token
+        self.sent = False
+
+    async def send(self, text: str):
+        line_bot_api = get_line_api()
+        m = _line_messaging
+        message = m.TextMessage(text=text[:4800]) # 限制長度
+        self.sent = True
+        if self.reply_token:
+            reply_token, self.reply_token = self.reply_token, None
+            try:
+                await line_bot_api.reply_message(
+                    m.ReplyMessageRequest(reply_token=reply_token, messages=[message])
+                )
+                logger.info("✅ 已使用 Reply 免費回覆")
+                return
+            except m.ApiException as e:
+                logger.warning("⚠️ Reply 失敗，改用 Push: %s", e)
+
+        if not self.to:
+            logger.warning("⚠️ 沒有可以 Push 的對象，放棄這則訊息")
+            return
+        try:
+            await line_bot_api.push_message(m.PushMessageRequest(to=self.to, messages=[message]))
+            logger.info("✅ 已使用 Push 回覆")
+        except m.ApiException as e:
+            logger.error("❌ Push 失敗: %s", e)
+
+# ---------- 訊息處理（背景執行）----------
+class EmptyCompletionError(Exception):
+    """DeepSeek 沒回任何內容；當錯誤處理，不能送出也不能進快取。"""
 
-def decide_response_params(user_msg: str):
-    length = len(user_msg)
-    if length < 20: return 150, "極簡回答。"
-    return 500, "正常回答。"
+async def process_message(to: str, reply_token: str, user_msg: str):
+    if not user_msg.strip():
+        return
+    replier = LineReplier(to, reply_token)
+    # 超長訊息直接擋掉，避免被拿來灌爆付費的 DeepSeek token
+    if len(user_msg) > MAX_USER_MSG_CHARS:
+        await replier.send("訊息太長啦，拆短一點再問！")
+        return
+    # 固定的 BASE_SYSTEM_PROMPT 放最前面，DeepSeek 會自動快取相同前綴；
+    # 每次不同的長度指示放在第二則 system 訊息，才不會破壞前綴
+    max_tokens, length_content = decide_response_params(user_msg)
+    # 短問題固定溫度 0，答案穩定才能放心快取
+    temperature = 0.0 if max_tokens <= 150 else 1.0
+    cacheable = temperature <= CACHEABLE_TEMPERATURE
+    key = exact_key("deepseek-chat", f"{PROMPT_VERSION}|{length_content}", user_msg,
+                    max_tokens, temperature)
+
+    async def call_deepseek():
+        streaming = max_tokens >= STREAM_MIN_TOKENS
+        response = await client.chat.completions.create(
+            model="deepseek-chat",
+            messages=[
+                {"role": "system", "content": BASE_SYSTEM_PROMPT},
+                {"role": "system", "content": length_content},
+                {"role": "user", "content": user_msg}
+            ],
+            max_tokens=max_tokens,
+            temperature=temperature,
+            stream=streaming,
+        )
+        if not streaming:
+            choice = response.choices[0]
+            if not choice.message.content:
+                raise EmptyCompletionError(choice.finish_reason)
+            return choice.message.content, choice.finish_reason
+
+        # 串流接收，湊滿一段就先送出；回傳完整回覆與 finish_reason 給快取判斷
+        stream = response
+        parts, buf, finish_reason = [], "", None
+        async for chunk in stream:
+            if not chunk.choices:
+                continue
+            choice = chunk.choices[0]
+            finish_reason = choice.finish_reason or finish_reason
+            buf += choice.delta.content or ""
+            ready, buf = split_flushable(buf, first=not replier.sent)
+            if ready:
+                parts.append(ready)
+                await replier.send(ready)
+        if buf.strip():
+            parts.append(buf)
+            await replier.send(buf)
+        if not parts:
+            raise EmptyCompletionError(finish_reason)
+        return "".join(parts), finish_reason
+
+    # 由便宜到貴：完全比對 → 語意比對（要算 embedding）→ DeepSeek
+    reply = await exact_cache.get(key) if cacheable else None
+    q_vec = None
+    namespace = f"{PROMPT_VERSION}:{max_tokens}"
+    # 太短的訊息 embedding 不可靠，不走語意快取也省下 embedding 計算
+    if reply is None and len(user_msg) >= MIN_SEMANTIC_CHARS:
+        # 模型推論是同步 CPU 運算，丟到 thread 才不會卡住 event loop
+        q_vec = await asyncio.to_thread(embed, user_msg)
+        reply = await semantic_cache.lookup(q_vec, namespace)
+
+    failed = False
+    if reply is None:
+        try:
+            reply, finish_reason = await call_deepseek()
+            # 被 max_tokens 截斷的回答不完整，照送但不快取
+            if finish_reason != "length":
+                if q_vec is not None:
+                    await semantic_cache.store(q_vec, namespace, reply)
+                if cacheable:
+                    await exact_cache.put(key, reply)
+        except EmptyCompletionError as e:
+            logger.warning("DeepSeek 回傳空白回覆 (finish_reason=%s)", e)
+            reply, failed = "腦袋打結，等下再問！", True
+        except APITimeoutError:
+            logger.warning("DeepSeek 逾時")
+            reply, failed = "腦袋打結，等下再問！", True
+        except APIError as e:
+            logger.error("DeepSeek API 錯誤: %s", e)
+            reply, failed = "腦袋打結，等下再問！", True
+        except Exception:
+            logger.exception("DeepSeek 呼叫失敗")
+            reply, failed = "腦袋打結，等下再問！", True
+
+    # 快取命中或錯誤時還沒送過任何訊息，整段一次送出；
+    # 串流送到一半才出錯的話，補一則說明，不要讓使用者只看到半個回答
+    if not replier.sent:
+        await replier.send(reply)
+    elif failed:
+        await replier.send("⚠️ 回答中斷了，等下再問一次！")
 
 # ---------- FastAPI 應用 ----------
-app = FastAPI()
+app = FastAPI(default_response_class=ORJSONResponse)
+
+@app.on_event("startup")
+async def warmup_embed_model():
+    # 在 worker fork 之後載入模型並先跑一次推論，第一個使用者就不用等模型初始化
+    await asyncio.to_thread(embed, "warmup")
+
+@app.on_event("shutdown")
+async def close_http_clients():
+    await shared_http.aclose()
+    if _line_api_client:
+        await _line_api_client.close()
+    if redis_client:
+        await redis_client.aclose()
+
+# 背景任務要留著參照，不然 event loop 只持有弱參照，可能被 GC 回收
+_background_tasks = set()
 
 @app.post("/webhook")
 async def webhook(request: Request, x_line_signature: str = Header(None)):
     body = await request.body()
-    if not verify_signature(body, x_line_signature):
-        return PlainTextResponse("OK")
 
+    # parser.parse 內部會驗證簽章，不必再自己算一次 HMAC
     try:
-        events = parser.parse(body.decode('utf-8'), x_line_signature)
+        events = parser.parse(body, x_line_signature)
+    except InvalidSignatureError:
+        return PlainTextResponse("OK")
     except Exception as e:
-        logger.error(f"解析錯誤: {e}")
+        logger.error("解析錯誤: %s", e)
         return PlainTextResponse("OK")
 
+    # LINE 約 1 秒內沒收到 200 就會重送，先回 OK，DeepSeek 放到背景處理；
+    # 每則訊息各自一個 task 同時跑，後面的訊息才不會等到 Reply Token 過期
     for event in events:
-        if isinstance(event, MessageEvent) and isinstance(event.message, TextMessage):
-            user_msg = event.message.text
-            # 修改重點：獲取此次事件的 reply_token
-            reply_token = event.reply_token 
-
-            max_tokens, length_instruction = decide_response_params(user_msg)
-            
-            try:
-                response = client.chat.completions.create(
-                    model="deepseek-chat",
-                    messages=[
-                        {"role": "system", "content": BASE_SYSTEM_PROMPT + length_instruction},
-                        {"role": "user", "content": user_msg}
-                    ],
-                    max_tokens=max_tokens,
-                )
-                reply = response.choices[0].message.content
-            except Exception:
-                reply = "腦袋打結，等下再問！"
-
-            # ---------- 核心修改：改用 reply_message (免費) ----------
-            try:
-                line_bot_api.reply_message(
-                    reply_token, # 使用 Token 回覆
-                    TextSendMessage(text=reply[:4800]) # 限制長度
-                )
-                logger.info("✅ 已使用 Reply 免費回覆")
-            except LineBotApiError as e:
-                logger.error(f"❌ Reply 失敗: {e}")
+        if isinstance(event, MessageEvent) and isinstance(event.message, TextMessageContent):
+            task = asyncio.create_task(process_message(
+                conversation_id(event.source), event.reply_token, event.message.text
+            ))
+            _background_tasks.add(task)
+            task.add_done_callback(_background_tasks.discard)
 
     return PlainTextResponse("OK")
 
 @app.get("/")
 async def root(): return {"status": "running"}
+
+@app.get("/cache-stats")
+async def cache_stats():
+    return {"exact": exact_cache.stats, "semantic": semantic_cache.stats}
+
+# 正式環境由 render.yaml 的 gunicorn + UvicornWorker 啟動，這裡只給本機開發用
+if __name__ == "__main__":
+    if not os.getenv("DEV_MODE"):
+        raise SystemExit("正式環境請用 render.yaml 的 gunicorn 啟動；本機開發請設定 DEV_MODE=1")
+    import uvicorn
+    # 多 worker 時必須傳 import 路徑字串；沒有 --preload，每個 worker 都會
+    # 各自載入一份 embedding 模型，所以本機預設只開 1 個
+    uvicorn.run(
+        "app:app",
+        host="0.0.0.0",
+        port=int(os.getenv("PORT", 8000)),
+        workers=int(os.getenv("WEB_CONCURRENCY", 1)),
+        loop="uvloop",
+        http="httptools",
+    )
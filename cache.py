@@ -0,0 +1,260 @@
+import time
+import threading
+import uuid
+import hashlib
+import logging
+from collections import OrderedDict
+
+import numpy as np
+import orjson
+
+logger = logging.getLogger(__name__)
+
+# ---------- 語意快取設定 ----------
+EMBED_MODEL_NAME = "sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2"
+SIMILARITY_THRESHOLD = 0.92
+# 溫度太高時同一問題每次答案都不同，不適合快取
+CACHEABLE_TEMPERATURE = 0.2
+
+# paraphrase-multilingual-MiniLM-L12-v2 的輸出維度
+EMBED_DIM = 384
+
+# 模型在第一次 embed() 時才載入，每個行程一份，之後重複使用。
+# 不在 import 時建立：gunicorn --preload 會在 master 先 import，fork 出來的
+# worker 拿不到 onnxruntime 的執行緒池，第一次推論可能卡死。
+_EMBED_MODEL = None
+_EMBED_MODEL_LOCK = threading.Lock()
+
+
+def _get_embed_model():
+    global _EMBED_MODEL
+    if _EMBED_MODEL is None:
+        with _EMBED_MODEL_LOCK:
+            if _EMBED_MODEL is None:
+                from sentence_transformers import SentenceTransformer
+                # ONNX backend 在 CPU 上推論比 PyTorch 快
+                _EMBED_MODEL = SentenceTransformer(EMBED_MODEL_NAME, device="cpu", backend="onnx")
+    return _EMBED_MODEL
+
+
+def embed(text: str) -> np.ndarray:
+    """回傳 L2 正規化後的 float32 向量，內積即為 cosine 相似度。"""
+    vec = _get_embed_model().encode(text, normalize_embeddings=True)
+    return np.asarray(vec, dtype=np.float32)
+
+
+def exact_key(model: str, system_content: str, user_msg: str,
+              max_tokens: int, temperature: float) -> str:
+    payload = {"m": model, "s": system_content, "u": user_msg,
+               "t": max_tokens, "temp": temperature}
+    return hashlib.sha256(orjson.dumps(payload, option=orjson.OPT_SORT_KEYS)).hexdigest()
+
+
+class ExactCache:
+    """完全相同 prompt 的 LRU 回覆快取，查詢只是一次 dict lookup。"""
+
+    def __init__(self, capacity: int = 4096, ttl_seconds: int = 3600):
+        self.capacity = capacity
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()  # key -> (created_at, reply)
+        self.stats = {"hits": 0, "misses": 0}
+
+    async def get(self, key: str):
+        entry = self._entries.get(key)
+        if entry and time.time() - entry[0] < self.ttl_seconds:
+            self._entries.move_to_end(key)
+            self.stats["hits"] += 1
+            return entry[1]
+        if entry:
+            del self._entries[key]
+        self.stats["misses"] += 1
+        return None
+
+    async def put(self, key: str, reply: str):
+        self._entries[key] = (time.time(), reply)
+        self._entries.move_to_end(key)
+        if len(self._entries) > self.capacity:
+            self._entries.popitem(last=False)
+
+
+class SemanticCache:
+    """以 embedding 相似度比對的 LRU 回覆快取。
+
+    每一列 embedding 存在固定大小的矩陣裡，OrderedDict 記錄列號的使用順序，
+    查詢時一次 matmul 算完所有相似度。namespace 用來區分不同的
+    max_tokens / 系統提示詞版本，避免短回答被拿去回覆長問題。
+    """
+
+    def __init__(self, capacity: int = 1024, threshold: float = SIMILARITY_THRESHOLD,
+                 ttl_seconds: int = 3600, dim: int = EMBED_DIM):
+        self.capacity = capacity
+        self.threshold = threshold
+        self.ttl_seconds = ttl_seconds
+        self._emb = np.zeros((capacity, dim), dtype=np.float32)
+        self._valid = np.zeros(capacity, dtype=bool)
+        self._ns = np.empty(capacity, dtype=object)
+        self._entries = OrderedDict()  # row -> (created_at, reply)
+        self.stats = {"hits": 0, "misses": 0}
+
+    def _drop(self, row: int):
+        self._entries.pop(row, None)
+        self._valid[row] = False
+
+    def _free_row(self) -> int:
+        if len(self._entries) < self.capacity:
+            return int(np.flatnonzero(~self._valid)[0])
+        row, _ = self._entries.popitem(last=False)  # 淘汰最久沒用到的
+        self._valid[row] = False
+        return row
+
+    async def lookup(self, q_vec: np.ndarray, namespace: str):
+        reply = self._search(q_vec, namespace)
+        self.stats["hits" if reply is not None else "misses"] += 1
+        return reply
+
+    def _search(self, q_vec: np.ndarray, namespace: str):
+        if not self._entries:
+            return None
+        mask = self._valid & (self._ns == namespace)
+        if not mask.any():
+            return None
+        sims = np.where(mask, self._emb @ q_vec, -1.0)
+        row = int(sims.argmax())
+        if sims[row] <= self.threshold:
+            return None
+        created_at, reply = self._entries[row]
+        if time.time() - created_at >= self.ttl_seconds:
+            self._drop(row)
+            return None
+        self._entries.move_to_end(row)
+        return reply
+
+    async def store(self, q_vec: np.ndarray, namespace: str, reply: str):
+        row = self._free_row()
+        self._emb[row] = q_vec
+        self._ns[row] = namespace
+        self._valid[row] = True
+        self._entries[row] = (time.time(), reply)
+
+
+class RedisExactCache:
+    """ExactCache 的 Redis 版本：多個 worker 共用，重啟也不會清空。"""
+
+    def __init__(self, redis_client, ttl_seconds: int = 3600):
+        self.redis = redis_client
+        self.ttl_seconds = ttl_seconds
+        self.stats = {"hits": 0, "misses": 0}
+
+    async def get(self, key: str):
+        try:
+            raw = await self.redis.get(f"ec:{key}")
+        except Exception as e:
+            logger.warning("Redis 讀取失敗，當作沒命中: %s", e)
+            raw = None
+        self.stats["hits" if raw is not None else "misses"] += 1
+        return raw.decode() if raw is not None else None
+
+    async def put(self, key: str, reply: str):
+        try:
+            await self.redis.set(f"ec:{key}", reply.encode(), ex=self.ttl_seconds)
+        except Exception as e:
+            logger.warning("Redis 寫入失敗: %s", e)
+
+
+class RedisSemanticCache:
+    """SemanticCache 的 Redis 版本，用 redis-stack 的 HNSW 向量索引找最近鄰。
+
+    每筆快取是一個 sc: 開頭的 hash，靠 EXPIRE 做 TTL，不另外限制筆數。
+    Redis 沒有 RediSearch 模組時（沒有 FT.* 指令），改用行程內的 SemanticCache。
+    """
+
+    INDEX_NAME = "sc_idx"
+
+    def __init__(self, redis_client, threshold: float = SIMILARITY_THRESHOLD,
+                 ttl_seconds: int = 3600):
+        self.redis = redis_client
+        self.threshold = threshold
+        self.ttl_seconds = ttl_seconds
+        self._index_ready = False
+        self._fallback = None
+        self.stats = {"hits": 0, "misses": 0}
+
+    @staticmethod
+    def _tag(namespace: str) -> str:
+        # TAG 查詢語法裡 ':' 之類的符號要跳脫，直接用雜湊值最省事
+        return hashlib.md5(namespace.encode()).hexdigest()
+
+    async def _ensure_index(self):
+        if self._index_ready:
+            return
+        try:
+            await self.redis.execute_command(
+                "FT.CREATE", self.INDEX_NAME, "ON", "HASH", "PREFIX", 1, "sc:",
+                "SCHEMA", "ns", "TAG",
+                "emb", "VECTOR", "HNSW", 6, "TYPE", "FLOAT32", "DIM", EMBED_DIM,
+                "DISTANCE_METRIC", "COSINE",
+            )
+        except Exception as e:
+            if "unknown command" in str(e).lower():
+                logger.warning("Redis 沒有 RediSearch 模組，語意快取改用行程內記憶體")
+                self._fallback = SemanticCache(threshold=self.threshold,
+                                               ttl_seconds=self.ttl_seconds)
+            elif "Index already exists" not in str(e):
+                raise
+        self._index_ready = True
+
+    async def _search(self, q_vec: np.ndarray, namespace: str):
+        await self._ensure_index()
+        if self._fallback:
+            return self._fallback._search(q_vec, namespace)
+        res = await self.redis.execute_command(
+            "FT.SEARCH", self.INDEX_NAME,
+            f"(@ns:{{{self._tag(namespace)}}})=>[KNN 1 @emb $vec AS score]",
+            "PARAMS", 2, "vec", q_vec.tobytes(),
+            "RETURN", 2, "reply", "score",
+            "DIALECT", 2,
+        )
+        if not res or res[0] == 0:
+            return None
+        fields = dict(zip(res[2][::2], res[2][1::2]))
+        # COSINE 回傳的是距離，相似度 = 1 - 距離
+        if 1.0 - float(fields[b"score"]) <= self.threshold:
+            return None
+        return fields[b"reply"].decode()
+
+    async def lookup(self, q_vec: np.ndarray, namespace: str):
+        try:
+            reply = await self._search(q_vec, namespace)
+        except Exception as e:
+            logger.warning("Redis 向量搜尋失敗，當作沒命中: %s", e)
+            reply = None
+        self.stats["hits" if reply is not None else "misses"] += 1
+        return reply
+
+    async def store(self, q_vec: np.ndarray, namespace: str, reply: str):
+        key = f"sc:{uuid.uuid4().hex}"
+        try:
+            await self._ensure_index()
+            if self._fallback:
+                await self._fallback.store(q_vec, namespace, reply)
+                return
+            await self.redis.hset(key, mapping={
+                "ns": self._tag(namespace),
+                "emb": q_vec.tobytes(),
+                "reply": reply.encode(),
+            })
+            await self.redis.expire(key, self.ttl_seconds)
+        except Exception as e:
+            logger.warning("Redis 寫入失敗: %s", e)
+
+
+def build_caches(redis_url: str = None):
+    """有設定 REDIS_URL 就用 Redis 讓所有 worker 共用快取，否則用行程內記憶體。
+
+    回傳 (exact_cache, semantic_cache, redis_client)。
+    """
+    if not redis_url:
+        return ExactCache(), SemanticCache(), None
+    import redis.asyncio as redis_asyncio
+    redis_client = redis_asyncio.Redis.from_url(redis_url, decode_responses=False)
+    return RedisExactCache(redis_client), RedisSemanticCache(redis_client), redis_client
@@ -0,0 +1,64 @@
+"""不依賴第三方套件的輔助函數：簽章驗證、回應長度判斷、串流分段。
+
+只用標準函式庫，import 很便宜，測試也不必載入模型或 LINE / OpenAI SDK。
+"""
+import base64
+import binascii
+import bisect
+import hashlib
+import hmac
+
+# ---------- 簽章驗證 ----------
+def verify_signature(body: bytes, signature: str, secret: bytes) -> bool:
+    if not secret: return False
+    # 把 header 解回原始 32 bytes 直接比，省掉把 digest 編成 base64 字串
+    try:
+        expected = base64.b64decode(signature or "", validate=True)
+    except (binascii.Error, ValueError):
+        return False
+    digest = hmac.new(secret, body, hashlib.sha256).digest()
+    # compare_digest 是固定時間比較，避免 timing attack
+    return hmac.compare_digest(digest, expected)
+
+# ---------- 回應長度 ----------
+# 第二則 system 訊息的完整內容，啟動時就組好，請求時不再拼字串
+SHORT_INSTRUCTION = "本次回應特別指示：極簡回答。"
+NORMAL_INSTRUCTION = "本次回應特別指示：正常回答。"
+
+# 長度分界與對應參數：長度 < 20 用第一組，其餘用第二組
+_LENGTH_THRESHOLDS = (20,)
+_RESPONSE_PARAMS = ((150, SHORT_INSTRUCTION), (500, NORMAL_INSTRUCTION))
+
+def decide_response_params(user_msg: str):
+    return _RESPONSE_PARAMS[bisect.bisect_right(_LENGTH_THRESHOLDS, len(user_msg))]
+
+# ---------- 串流分段 ----------
+# 只有長回答才串流；短回答一次用 reply_message 送完，不吃 push 額度
+STREAM_MIN_TOKENS = 500
+SENTENCE_ENDS = "。！？"
+STREAM_FIRST_MIN_CHARS = 50
+STREAM_FLUSH_CHARS = 200
+# 一直等不到句尾時，累積到這個長度就整段送出
+STREAM_FORCE_CHARS = 400
+
+def split_flushable(buf: str, first: bool):
+    """把串流緩衝切成 (現在要送的, 留著繼續累積的)。
+
+    第一段湊滿 STREAM_FIRST_MIN_CHARS 字並遇到句尾就送出，讓使用者盡快
+    看到回覆；之後累積到 STREAM_FLUSH_CHARS 字再送，避免一句一則訊息洗版。
+    """
+    min_chars = STREAM_FIRST_MIN_CHARS if first else STREAM_FLUSH_CHARS
+    if len(buf) < min_chars:
+        return "", buf
+    cut = max(buf.rfind(c) for c in SENTENCE_ENDS)
+    if cut + 1 >= min_chars:
+        return buf[:cut + 1], buf[cut + 1:]
+    if len(buf) >= STREAM_FORCE_CHARS:
+        return buf, ""
+    return "", buf
+
+def conversation_id(source):
+    """push 的對象：群組、聊天室要推回原本的對話，不是發話者的 1:1 聊天。"""
+    return (getattr(source, "group_id", None)
+            or getattr(source, "room_id", None)
+            or getattr(source, "user_id", None))
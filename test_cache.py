@@ -0,0 +1,158 @@
+import asyncio
+import logging
+
+import numpy as np
+import pytest
+
+import cache
+from cache import ExactCache, RedisSemanticCache, SemanticCache
+
+
+def vec(*xs) -> np.ndarray:
+    v = np.asarray(xs, dtype=np.float32)
+    return v / np.linalg.norm(v)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(cache.time, "time", lambda: now[0])
+    return now
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+# ---------- SemanticCache ----------
+def test_semantic_hit_and_stats():
+    c = SemanticCache(capacity=4, dim=3)
+    run(c.store(vec(1, 0, 0), "ns", "答案"))
+    assert run(c.lookup(vec(1, 0, 0), "ns")) == "答案"
+    assert run(c.lookup(vec(0, 1, 0), "ns")) is None
+    assert c.stats == {"hits": 1, "misses": 1}
+
+
+def test_semantic_namespace_is_masked():
+    c = SemanticCache(capacity=4, dim=3)
+    run(c.store(vec(1, 0, 0), "v3:150", "短答"))
+    assert run(c.lookup(vec(1, 0, 0), "v3:500")) is None
+
+
+def test_semantic_threshold_is_exclusive():
+    stored = np.array([0.5, np.sqrt(0.75), 0.0], dtype=np.float32)
+    query = vec(1, 0, 0)
+    assert float(stored @ query) == 0.5
+    c = SemanticCache(capacity=4, threshold=0.5, dim=3)
+    run(c.store(stored, "ns", "答案"))
+    assert run(c.lookup(query, "ns")) is None
+    c.threshold = 0.49
+    assert run(c.lookup(query, "ns")) == "答案"
+
+
+def test_semantic_lru_evicts_least_recently_used(clock):
+    c = SemanticCache(capacity=2, dim=3)
+    run(c.store(vec(1, 0, 0), "ns", "a"))
+    run(c.store(vec(0, 1, 0), "ns", "b"))
+    assert run(c.lookup(vec(1, 0, 0), "ns")) == "a"  # a 變成最近用過
+    run(c.store(vec(0, 0, 1), "ns", "c"))
+    assert run(c.lookup(vec(0, 1, 0), "ns")) is None
+    assert run(c.lookup(vec(1, 0, 0), "ns")) == "a"
+    assert run(c.lookup(vec(0, 0, 1), "ns")) == "c"
+
+
+def test_semantic_ttl_drops_row_and_reuses_it(clock):
+    c = SemanticCache(capacity=2, ttl_seconds=15, dim=3)
+    run(c.store(vec(1, 0, 0), "ns", "a"))  # row 0
+    clock[0] += 10
+    run(c.store(vec(0, 1, 0), "ns", "b"))  # row 1
+    clock[0] += 10
+    assert run(c.lookup(vec(1, 0, 0), "ns")) is None
+    assert not c._valid[0] and 0 not in c._entries
+    # 過期空出來的 row 0 會被重複使用，不必淘汰還沒過期的 b
+    assert c._free_row() == 0
+    run(c.store(vec(0, 0, 1), "ns", "c"))
+    assert run(c.lookup(vec(0, 1, 0), "ns")) == "b"
+    assert run(c.lookup(vec(0, 0, 1), "ns")) == "c"
+
+
+# ---------- ExactCache ----------
+def test_exact_hit_and_ttl_expiry(clock):
+    c = ExactCache(ttl_seconds=60)
+    run(c.put("k", "答案"))
+    assert run(c.get("k")) == "答案"
+    clock[0] += 60
+    assert run(c.get("k")) is None
+    assert "k" not in c._entries
+    assert c.stats == {"hits": 1, "misses": 1}
+
+
+def test_exact_capacity_pops_least_recently_used():
+    c = ExactCache(capacity=2)
+    run(c.put("a", "1"))
+    run(c.put("b", "2"))
+    assert run(c.get("a")) == "1"  # a 變成最近用過
+    run(c.put("c", "3"))
+    assert list(c._entries) == ["a", "c"]
+    assert run(c.get("b")) is None
+
+
+def test_exact_default_capacity():
+    c = ExactCache()
+    for i in range(4097):
+        run(c.put(str(i), "x"))
+    assert len(c._entries) == 4096
+    assert "0" not in c._entries
+
+
+# ---------- RedisSemanticCache ----------
+class FakeRedis:
+    """只記錄呼叫的 Redis 替身；FT.* 指令依 ft_error 決定要不要丟錯。"""
+
+    def __init__(self, ft_error=None):
+        self.ft_error = ft_error
+        self.commands = []
+        self.hsets = []
+
+    async def execute_command(self, *args):
+        self.commands.append(args[0])
+        if self.ft_error:
+            raise Exception(self.ft_error)
+        return [0]
+
+    async def hset(self, key, mapping):
+        self.hsets.append(key)
+
+    async def expire(self, key, seconds):
+        pass
+
+
+def dim_vec(i: int) -> np.ndarray:
+    v = np.zeros(cache.EMBED_DIM, dtype=np.float32)
+    v[i] = 1.0
+    return v
+
+
+def test_redis_semantic_falls_back_without_redisearch(caplog):
+    redis = FakeRedis(ft_error="unknown command 'FT.CREATE', with args beginning with: 'sc_idx'")
+    c = RedisSemanticCache(redis)
+    with caplog.at_level(logging.WARNING, logger="cache"):
+        assert run(c.lookup(dim_vec(0), "ns")) is None
+        run(c.store(dim_vec(0), "ns", "答案"))
+        assert run(c.lookup(dim_vec(0), "ns")) == "答案"
+        assert run(c.lookup(dim_vec(1), "ns")) is None
+    # 只試一次 FT.CREATE，之後都走行程內快取，不再打 Redis
+    assert redis.commands == ["FT.CREATE"]
+    assert redis.hsets == []
+    assert len(caplog.records) == 1
+    assert c.stats == {"hits": 1, "misses": 2}
+
+
+def test_redis_semantic_existing_index_uses_redis():
+    redis = FakeRedis()
+    c = RedisSemanticCache(redis)
+    assert run(c.lookup(dim_vec(0), "ns")) is None
+    run(c.store(dim_vec(0), "ns", "答案"))
+    assert c._fallback is None
+    assert redis.commands == ["FT.CREATE", "FT.SEARCH"]
+    assert len(redis.hsets) == 1
@@ -0,0 +1,74 @@
+import base64
+import hashlib
+import hmac
+
+import helpers
+from helpers import split_flushable, verify_signature
+
+SECRET = b"test-channel-secret"
+BODY = b'{"destination":"U0","events":[]}'
+
+
+def sign(body: bytes, secret: bytes = SECRET) -> str:
+    return base64.b64encode(hmac.new(secret, body, hashlib.sha256).digest()).decode()
+
+
+# ---------- verify_signature ----------
+def test_verify_signature_valid():
+    assert verify_signature(BODY, sign(BODY), SECRET)
+
+
+def test_verify_signature_wrong_signature():
+    assert not verify_signature(BODY, sign(BODY, b"other-secret"), SECRET)
+
+
+def test_verify_signature_missing_header():
+    assert not verify_signature(BODY, None, SECRET)
+
+
+def test_verify_signature_not_base64():
+    assert not verify_signature(BODY, "這不是 base64!", SECRET)
+
+
+def test_verify_signature_wrong_length():
+    assert not verify_signature(BODY, base64.b64encode(b"\x00" * 16).decode(), SECRET)
+
+
+def test_verify_signature_without_secret():
+    assert not verify_signature(BODY, sign(BODY), b"")
+
+
+# ---------- split_flushable ----------
+def test_split_flushable_holds_short_first_segment():
+    buf = "哈哈！西曬牆建議選耐旱的多肉。"
+    assert split_flushable(buf, first=True) == ("", buf)
+
+
+def test_split_flushable_first_segment_at_sentence_end():
+    head = "哈" * (helpers.STREAM_FIRST_MIN_CHARS - 1) + "。"
+    assert split_flushable(head + "尾巴", first=True) == (head, "尾巴")
+
+
+def test_split_flushable_first_segment_needs_min_chars_before_sentence_end():
+    buf = "哈哈！" + "好" * helpers.STREAM_FIRST_MIN_CHARS
+    assert split_flushable(buf, first=True) == ("", buf)
+
+
+def test_split_flushable_later_segments_wait_for_flush_chars():
+    buf = "好" * (helpers.STREAM_FLUSH_CHARS - 2) + "。"
+    assert split_flushable(buf, first=False) == ("", buf)
+
+
+def test_split_flushable_later_segment_at_sentence_end():
+    head = "好" * (helpers.STREAM_FLUSH_CHARS - 1) + "！"
+    assert split_flushable(head + "下一句", first=False) == (head, "下一句")
+
+
+def test_split_flushable_waits_for_sentence_end():
+    buf = "好" * (helpers.STREAM_FORCE_CHARS - 1)
+    assert split_flushable(buf, first=False) == ("", buf)
+
+
+def test_split_flushable_forces_long_buffer_without_sentence_end():
+    buf = "好" * helpers.STREAM_FORCE_CHARS
+    assert split_flushable(buf, first=False) == (buf, "")